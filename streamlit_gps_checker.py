@@ -1,11 +1,18 @@
 import streamlit as st
-import gpxpy
+import io
+from lxml import etree
 import requests
-from shapely.geometry import Point
-from geopy.distance import geodesic
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import pandas as pd
 import pydeck as pdk
-import time
+import re
+import orjson
+import diskcache
+import zstandard
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import numpy as np
+from numba import njit
 from datetime import datetime
 import altair as alt
 
@@ -20,63 +27,183 @@ skip_downsample = st.sidebar.checkbox("No reducir puntos (usar todos)", value=Fa
 add_randomness = st.sidebar.checkbox("Añadir pequeña aleatoriedad al riesgo", value=False)
 skip_weather = st.sidebar.checkbox("Omitir análisis meteorológico (más rápido)", value=True)
 
+OVERPASS_URL = "http://overpass-api.de/api/interpreter"
+OVERPASS_STATUS_URL = "http://overpass-api.de/api/status"
+TILE_ZOOM = 15  # teselas de ~1 km de lado
+OVERPASS_DEFAULT_SLOTS = 2  # slots habituales por IP en overpass-api.de
+OVERPASS_MAX_WORKERS = 4
+OVERPASS_TIMEOUT = (5, 90)  # (conexión, lectura): cubre el [timeout:60] de la consulta
+DISK_CACHE_TTL = 7 * 86400
+WEATHER_URL = "https://api.open-meteo.com/v1/forecast"
+WEATHER_BATCH_SIZE = 100
+WEATHER_MAX_WORKERS = 4
+WEATHER_TIMEOUT = (5, 15)
+NO_WEATHER = {"clouds": None, "precip": None, "visibility": None}
+DANGER_COLOR = [200, 30, 0]
+SAFE_COLOR = [50, 200, 50]
+
+# Recursos compartidos entre reruns
+@st.cache_resource(show_spinner=False)
+def get_session():
+    # Conexiones HTTP reutilizadas (keep-alive) con reintentos y backoff ante 429/502/504
+    adapter = HTTPAdapter(
+        pool_connections=8, pool_maxsize=8,
+        max_retries=Retry(total=3, backoff_factor=1, status_forcelist=[429, 502, 504]),
+    )
+    session = requests.Session()
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
+    return session
+
+@st.cache_resource(show_spinner=False)
+def get_disk_cache():
+    return diskcache.Cache(".overpass_cache", size_limit=2**30)
+
 # Funciones
 def downsample(points, step):
     return points[::step] if step > 1 else points
 
-def read_gpx_points(file):
-    gpx = gpxpy.parse(file)
-    return [(p.latitude, p.longitude, p.time) for track in gpx.tracks
-            for segment in track.segments
-            for p in segment.points if p.time]
-
-def overpass_query(lat, lon, radius_m):
-    radius_deg = radius_m / 111000
-    lat1, lon1 = lat - radius_deg, lon - radius_deg
-    lat2, lon2 = lat + radius_deg, lon + radius_deg
+@st.cache_data(show_spinner=False)
+def read_gpx_points(file_bytes):
+    # Lectura en streaming: se liberan los <trkpt> ya procesados para no mantener el DOM entero
+    lats, lons, times = [], [], []
+    # El GPX lo sube el usuario: sin resolver entidades externas ni acceder a la red (XXE)
+    events = etree.iterparse(io.BytesIO(file_bytes), tag="{*}trkpt", resolve_entities=False, no_network=True)
+    for _, el in events:
+        t = el.find("{*}time")
+        if t is not None and t.text:
+            lats.append(float(el.get("lat")))
+            lons.append(float(el.get("lon")))
+            times.append(t.text.strip())
+        el.clear()
+        while el.getprevious() is not None:
+            del el.getparent()[0]
+    times = pd.to_datetime(times, utc=True, format="ISO8601").tz_localize(None)
+    return np.array(lats), np.array(lons), times.to_numpy().astype("datetime64[s]")
+
+def overpass_query(bbox, min_height):
+    lat1, lon1, lat2, lon2 = bbox
     query = f"""
-    [out:json][timeout:25];
+    [out:json][timeout:60];
     (
-      way["building"]["height"]({lat1},{lon1},{lat2},{lon2});
+      way["building"]["height"](if: number(t["height"]) >= {min_height})({lat1},{lon1},{lat2},{lon2});
     );
-    out center;
+    out ids center;
     """
-    r = requests.get("http://overpass-api.de/api/interpreter", params={"data": query})
+    r = get_session().get(OVERPASS_URL, params={"data": query}, timeout=OVERPASS_TIMEOUT)
     r.raise_for_status()
-    return r.json()
-
-def buildings_near(point, buildings, radius, height_thresh):
-    close = []
-    for b in buildings.get("elements", []):
-        if "tags" in b and "height" in b["tags"]:
-            try:
-                h = float(b["tags"]["height"])
-                if h >= height_thresh:
-                    center = b.get("center")
-                    if center:
-                        dist = geodesic(point, (center["lat"], center["lon"])).meters
-                        if dist <= radius:
-                            close.append({
-                                "lat": center["lat"],
-                                "lon": center["lon"],
-                                "height": h
-                            })
-            except:
+    result = orjson.loads(r.content)
+    # Si la consulta agota [timeout:60] o la memoria, Overpass responde 200 con "remark" y datos incompletos
+    if result.get("remark"):
+        raise RuntimeError(f"Overpass devolvió una respuesta incompleta: {result['remark']}")
+    return result
+
+@st.cache_data(ttl=60, show_spinner=False)
+def overpass_slots():
+    # "Rate limit: N" en /api/status; 0 significa sin límite para esta IP
+    try:
+        r = get_session().get(OVERPASS_STATUS_URL, timeout=5)
+        r.raise_for_status()
+        match = re.search(r"Rate limit: (\d+)", r.text)
+    except requests.RequestException:
+        return OVERPASS_DEFAULT_SLOTS
+    if not match:
+        return OVERPASS_DEFAULT_SLOTS
+    slots = int(match.group(1))
+    return min(slots, OVERPASS_MAX_WORKERS) if slots else OVERPASS_MAX_WORKERS
+
+@st.cache_data(ttl=86400, show_spinner=False)
+def cached_overpass_tile(x, y, min_height):
+    # Segunda capa de caché en disco (comprimida) que sobrevive a reinicios de la app
+    key = f"z{TILE_ZOOM}/{x}/{y}/h{min_height}"
+    disk_cache = get_disk_cache()
+    blob = disk_cache.get(key)
+    if blob is not None:
+        cached = orjson.loads(zstandard.decompress(blob))
+        if not cached.get("remark"):
+            return cached
+        # Entrada incompleta guardada por versiones anteriores: se descarta y se vuelve a consultar
+        disk_cache.delete(key)
+    result = overpass_query(tile_bbox(x, y), min_height)
+    disk_cache.set(key, zstandard.compress(orjson.dumps(result)), expire=DISK_CACHE_TTL)
+    return result
+
+def tile_bbox(x, y):
+    # Tesela slippy-map (x, y) a TILE_ZOOM -> (lat1, lon1, lat2, lon2)
+    n = 2 ** TILE_ZOOM
+    lon1, lon2 = x / n * 360 - 180, (x + 1) / n * 360 - 180
+    lat2 = float(np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * y / n)))))
+    lat1 = float(np.degrees(np.arctan(np.sinh(np.pi * (1 - 2 * (y + 1) / n)))))
+    return (lat1, lon1, lat2, lon2)
+
+def track_tiles(lats, lons, radius_deg):
+    # Teselas fijas que toca algún punto (con su radio): recorridos cercanos comparten caché
+    lon_deg = radius_deg / np.cos(np.radians(np.abs(lats).max()))
+    n = 2 ** TILE_ZOOM
+    tiles = set()
+    for dlat in (-radius_deg, radius_deg):
+        for dlon in (-lon_deg, lon_deg):
+            x = np.floor((lons + dlon + 180) / 360 * n).astype(int)
+            y = np.floor((1 - np.arcsinh(np.tan(np.radians(lats + dlat))) / np.pi) / 2 * n).astype(int)
+            tiles.update(zip(x.tolist(), y.tolist()))
+    return sorted(tiles)
+
+def fetch_all_buildings(lats, lons, radius_m, min_height, on_progress=None):
+    radius_deg = radius_m / 111000
+    tiles = track_tiles(lats, lons, radius_deg)
+    buildings = {}
+    with ThreadPoolExecutor(max_workers=overpass_slots()) as executor:
+        futures = [executor.submit(cached_overpass_tile, *tile, min_height) for tile in tiles]
+        for done, future in enumerate(as_completed(futures), 1):
+            for b in future.result().get("elements", []):
+                buildings[b["id"]] = b
+            if on_progress:
+                on_progress(done, len(tiles))
+    return list(buildings.values())
+
+def building_arrays(buildings):
+    centers = [b["center"] for b in buildings if "center" in b]
+    bld_lat = np.fromiter((c["lat"] for c in centers), dtype=float, count=len(centers))
+    bld_lon = np.fromiter((c["lon"] for c in centers), dtype=float, count=len(centers))
+    return bld_lat, bld_lon
+
+def project_local(lats, lons, lat0, lon0):
+    # Proyección equirectangular local en metros: a estas distancias basta con distancia euclídea
+    x = (lons - lon0) * 111320 * np.cos(np.radians(lat0))
+    y = (lats - lat0) * 110540
+    return x, y
+
+@njit(fastmath=True, cache=True)
+def count_hits(px, py, bx, by, r):
+    # bx ordenado: para cada punto solo se recorre la franja [px - r, px + r]
+    out = np.zeros(px.size, np.int32)
+    r2 = r * r
+    for i in range(px.size):
+        lo = np.searchsorted(bx, px[i] - r)
+        hi = np.searchsorted(bx, px[i] + r, side="right")
+        c = 0
+        for j in range(lo, hi):
+            dy = py[i] - by[j]
+            if abs(dy) > r:
                 continue
-    return close
-
-def build_colored_segments(points, danger_indices):
-    segments = []
-    for i in range(len(points) - 1):
-        lat1, lon1 = points[i][:2]
-        lat2, lon2 = points[i + 1][:2]
-        is_danger = i in danger_indices or i + 1 in danger_indices
-        color = [200, 30, 0] if is_danger else [50, 200, 50]
-        segments.append({
-            "path": [[lon1, lat1], [lon2, lat2]],
-            "color": color
-        })
-    return segments
+            dx = px[i] - bx[j]
+            if dx * dx + dy * dy <= r2:
+                c += 1
+        out[i] = c
+    return out
+
+def count_buildings_near(pts_lat, pts_lon, bld_lat, bld_lon, radius_m):
+    lat0, lon0 = pts_lat.mean(), pts_lon.mean()
+    pts_x, pts_y = project_local(pts_lat, pts_lon, lat0, lon0)
+    bld_x, bld_y = project_local(bld_lat, bld_lon, lat0, lon0)
+    order = np.argsort(bld_x)
+    return count_hits(pts_x, pts_y, bld_x[order], bld_y[order], float(radius_m))
+
+def build_colored_segments(lats, lons, danger_mask):
+    is_danger = danger_mask[:-1] | danger_mask[1:]
+    paths = np.stack([lons[:-1], lats[:-1], lons[1:], lats[1:]], axis=1).reshape(-1, 2, 2)
+    colors = np.where(is_danger[:, None], DANGER_COLOR, SAFE_COLOR)
+    return pd.DataFrame({"path": paths.tolist(), "color": colors.tolist()})
 
 def estimate_gps_quality(danger_ratio):
     if danger_ratio > 0.5:
@@ -86,19 +213,45 @@ def estimate_gps_quality(danger_ratio):
     else:
         return "✅ Alta"
 
-def get_weather_data(lat, lon, dt):
-    iso_time = dt.strftime('%Y-%m-%dT%H:%M')
-    url = f"https://api.open-meteo.com/v1/forecast?latitude={lat}&longitude={lon}&hourly=cloudcover,precipitation,visibility&start={iso_time}&end={iso_time}&timezone=UTC"
-    try:
-        r = requests.get(url)
-        r.raise_for_status()
-        data = r.json()
-        clouds = data.get("hourly", {}).get("cloudcover", [None])[0]
-        rain = data.get("hourly", {}).get("precipitation", [None])[0]
-        vis = data.get("hourly", {}).get("visibility", [None])[0]
-        return {"clouds": clouds, "precip": rain, "visibility": vis}
-    except:
-        return {"clouds": None, "precip": None, "visibility": None}
+def weather_batches(times):
+    # Open-Meteo admite varias coordenadas por petición: un lote por día y hasta WEATHER_BATCH_SIZE puntos
+    days = np.datetime_as_string(times, unit="D")
+    batches = []
+    for day in np.unique(days):
+        idx = np.flatnonzero(days == day)
+        for start in range(0, len(idx), WEATHER_BATCH_SIZE):
+            batches.append((day, idx[start:start + WEATHER_BATCH_SIZE]))
+    return batches
+
+def get_weather_batch(lats, lons, times, day):
+    params = {
+        "latitude": ",".join(f"{lat:.4f}" for lat in lats),
+        "longitude": ",".join(f"{lon:.4f}" for lon in lons),
+        "hourly": "cloudcover,precipitation,visibility",
+        "start_date": day,
+        "end_date": day,
+        "timezone": "UTC",
+    }
+    r = get_session().get(WEATHER_URL, params=params, timeout=WEATHER_TIMEOUT)
+    r.raise_for_status()
+    data = orjson.loads(r.content)
+    locations = data if isinstance(data, list) else [data]
+
+    hours = np.char.add(np.datetime_as_string(times, unit="h"), ":00")
+    results = []
+    for location, hour in zip(locations, hours):
+        hourly = location.get("hourly", {})
+        hourly_times = np.array(hourly.get("time", []))
+        k = np.searchsorted(hourly_times, hour)
+        if k < len(hourly_times) and hourly_times[k] == hour:
+            results.append({
+                "clouds": hourly["cloudcover"][k],
+                "precip": hourly["precipitation"][k],
+                "visibility": hourly["visibility"][k],
+            })
+        else:
+            results.append(NO_WEATHER)
+    return results
 
 def compute_weather_score(clouds, precip, visibility):
     if clouds is None or precip is None or visibility is None:
@@ -106,12 +259,22 @@ def compute_weather_score(clouds, precip, visibility):
     score = 100 - (clouds * 0.3 + precip * 5 + (10 - min(visibility, 10)) * 5)
     return max(0, min(100, score))
 
+@st.cache_resource(show_spinner=False)
+def warm_up_kernels():
+    # Compila (o carga de la caché de Numba) count_hits una sola vez por proceso, con el primer GPX
+    dummy = np.zeros(1)
+    count_hits(dummy, dummy, dummy, dummy, 1.0)
+
 # Main
 if uploaded_file:
+    warm_up_kernels()
     st.title("📍 Análisis de Precisión GPS")
 
-    raw_points = read_gpx_points(uploaded_file)
-    num_raw = len(raw_points)
+    raw_lats, raw_lons, raw_times = read_gpx_points(uploaded_file.getvalue())
+    num_raw = len(raw_lats)
+    if num_raw == 0:
+        st.error("El archivo GPX no contiene puntos de track con marca de tiempo.")
+        st.stop()
 
     # Downsampling
     if skip_downsample:
@@ -125,53 +288,69 @@ if uploaded_file:
     else:
         step = 12
 
-    points = downsample(raw_points, step)
+    lats = downsample(raw_lats, step)
+    lons = downsample(raw_lons, step)
+    times = downsample(raw_times, step)
+    num_points = len(lats)
     st.sidebar.markdown(f"🔢 Puntos originales: {num_raw}")
-    st.sidebar.markdown(f"📉 Tras reducción: {len(points)} (cada {step} puntos)")
+    st.sidebar.markdown(f"📉 Tras reducción: {num_points} (cada {step} puntos)")
 
-    danger_zones = []
-    danger_indices = set()
     weather_scores = []
 
-    progress_bar = st.progress(0, text="⏳ Analizando puntos...")
+    progress_bar = st.progress(0, text="⏳ Descargando edificios...")
     status_text = st.empty()
 
-    with st.spinner("Procesando puntos del recorrido..."):
-        for i, (lat, lon, t) in enumerate(points):
-            try:
-                buildings = overpass_query(lat, lon, radius_m)
-                nearby = buildings_near((lat, lon), buildings, radius_m, min_height)
-
-                if not skip_weather:
-                    weather = get_weather_data(lat, lon, t)
-                    score = compute_weather_score(weather["clouds"], weather["precip"], weather["visibility"])
-                    if score is not None:
-                        weather_scores.append(score)
-                else:
-                    weather = {"clouds": None, "precip": None, "visibility": None}
-
-                if nearby:
-                    danger_zones.append({
-                        "index": i,
-                        "lat": lat,
-                        "lon": lon,
-                        "time": t,
-                        "num_buildings": len(nearby),
-                        "weather": weather
-                    })
-                    danger_indices.add(i)
-            except Exception as e:
-                st.warning(f"Error en punto #{i}: {e}")
-
-            percent = int((i + 1) / len(points) * 100)
-            progress_bar.progress((i + 1) / len(points), text=f"⏳ Analizando puntos... {percent}%")
-            status_text.text(f"{i + 1}/{len(points)} puntos analizados")
-            time.sleep(0.01)
+    def show_tile_progress(done, total):
+        percent = int(done / total * 100)
+        progress_bar.progress(done / total, text=f"⏳ Descargando edificios... {percent}%")
+        status_text.text(f"{done}/{total} teselas descargadas")
+
+    with st.spinner("Descargando edificios de OpenStreetMap..."):
+        try:
+            buildings = fetch_all_buildings(lats, lons, radius_m, min_height, on_progress=show_tile_progress)
+        except Exception as e:
+            st.error(f"Error consultando Overpass: {e}")
+            st.stop()
+
+    bld_lat, bld_lon = building_arrays(buildings)
+    num_buildings = count_buildings_near(lats, lons, bld_lat, bld_lon, radius_m)
+
+    weather = [NO_WEATHER] * num_points
+    if not skip_weather:
+        progress_bar.progress(0, text="⏳ Analizando puntos...")
+        status_text.empty()
+        with st.spinner("Consultando el clima del recorrido..."):
+            with ThreadPoolExecutor(max_workers=WEATHER_MAX_WORKERS) as executor:
+                futures = {
+                    executor.submit(get_weather_batch, lats[idx], lons[idx], times[idx], day): idx
+                    for day, idx in weather_batches(times)
+                }
+                done = 0
+                for future in as_completed(futures):
+                    idx = futures[future]
+                    try:
+                        for i, w in zip(idx, future.result()):
+                            weather[i] = w
+                    except Exception as e:
+                        st.warning(f"Error consultando el clima de {len(idx)} puntos: {e}")
+
+                    done += len(idx)
+                    percent = int(done / num_points * 100)
+                    progress_bar.progress(done / num_points, text=f"⏳ Analizando puntos... {percent}%")
+                    status_text.text(f"{done}/{num_points} puntos analizados")
+
+        for w in weather:
+            score = compute_weather_score(w["clouds"], w["precip"], w["visibility"])
+            if score is not None:
+                weather_scores.append(score)
+
+    danger_mask = num_buildings > 0
+    danger_idx = np.flatnonzero(danger_mask)
 
     status_text.empty()
     progress_bar.empty()
 
-    danger_ratio = len(danger_indices) / len(points)
+    danger_ratio = danger_mask.mean()
     quality = estimate_gps_quality(danger_ratio)
 
     if weather_scores and not skip_weather:
@@ -180,18 +359,24 @@ if uploaded_file:
 
     st.subheader(f"📡 Calificación estimada de precisión GPS: {quality}")
 
-    if danger_zones:
-        df = pd.DataFrame([{**dz, **dz['weather']} for dz in danger_zones])
-        df = df.drop(columns=["weather"])
-        st.success(f"Se encontraron {len(danger_zones)} puntos con condiciones adversas.")
+    if len(danger_idx):
+        df = pd.DataFrame({
+            "index": danger_idx,
+            "lat": lats[danger_idx],
+            "lon": lons[danger_idx],
+            "time": times[danger_idx],
+            "num_buildings": num_buildings[danger_idx],
+            **{k: [weather[i][k] for i in danger_idx] for k in NO_WEATHER},
+        })
+        st.success(f"Se encontraron {len(danger_idx)} puntos con condiciones adversas.")
         st.dataframe(df)
 
         st.subheader("🗺️ Mapa de zonas peligrosas")
-        map_df = pd.DataFrame([{
-            "lat": dz["lat"],
-            "lon": dz["lon"],
-            "elev": dz["num_buildings"] * 5
-        } for dz in danger_zones])
+        map_df = pd.DataFrame({
+            "lat": lats[danger_idx],
+            "lon": lons[danger_idx],
+            "elev": num_buildings[danger_idx] * 5,
+        })
 
         st.pydeck_chart(pdk.Deck(
             initial_view_state=pdk.ViewState(
@@ -216,13 +401,12 @@ if uploaded_file:
         ))
 
         st.subheader("📍 Recorrido completo con color de riesgo")
-        segments = build_colored_segments(points, danger_indices)
-        segment_df = pd.DataFrame(segments)
+        segment_df = build_colored_segments(lats, lons, danger_mask)
 
         st.pydeck_chart(pdk.Deck(
             initial_view_state=pdk.ViewState(
-                latitude=sum(p[0] for p in points) / len(points),
-                longitude=sum(p[1] for p in points) / len(points),
+                latitude=lats.mean(),
+                longitude=lons.mean(),
                 zoom=15,
                 pitch=0,
             ),
@@ -241,10 +425,9 @@ if uploaded_file:
 
         # Gráficas
         st.subheader("📈 Calidad GPS (%) vs. Puntos del recorrido")
-        quality_series = [1 if i in danger_indices else 0 for i in range(len(points))]
         df_quality = pd.DataFrame({
-            "Punto": list(range(len(points))),
-            "Riesgo": quality_series
+            "Punto": np.arange(num_points),
+            "Riesgo": danger_mask.astype(int)
         })
 
         st.altair_chart(